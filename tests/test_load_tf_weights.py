@@ -0,0 +1,248 @@
+import os
+import sys
+import types
+from operator import attrgetter
+
+import numpy as np
+import pytest
+import torch
+
+from efficientnet_pytorch import EfficientNet
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tf_to_pytorch', 'convert_tf_to_pt'))
+import load_tf_weights  # noqa: E402
+from load_tf_weights import (TRANSFORMS, IDENTITY, CONV_KERNEL, POINTWISE_KERNEL,  # noqa: E402
+                             DEPTHWISE_KERNEL, DENSE_KERNEL)
+
+
+# -- fixtures -------------------------------------------------------------------------------------
+
+@pytest.fixture(scope='module', params=[x for x in range(4)])
+def model(request):
+    return EfficientNet.from_name('efficientnet-b{}'.format(request.param))
+
+
+@pytest.fixture(scope='function')
+def checkpoint(monkeypatch):
+    """Random TF-layout arrays for every B0 variable, served by a fake `tensorflow` module"""
+    net = EfficientNet.from_name('efficientnet-b0')
+    names = {id(pyt_param): 'efficientnet-b0/' + tf_param_name
+             for pyt_param, tf_param_name in baseline_conversion_table(net).items()}
+    arrays = {}
+    for pyt_param in net.state_dict(keep_vars=True).values():
+        if id(pyt_param) in names:
+            tf_param_name = names[id(pyt_param)]
+            arrays[tf_param_name] = np.random.rand(*tf_layout_shape(tf_param_name, pyt_param.shape)).astype(np.float32)
+
+    reader = FakeCheckpointReader(arrays)
+    fake_tf = types.ModuleType('tensorflow')
+    fake_tf.train = types.SimpleNamespace(load_checkpoint=lambda checkpoint_file: reader)
+    monkeypatch.setitem(sys.modules, 'tensorflow', fake_tf)
+    return net, names, reader
+
+
+# -- helpers --------------------------------------------------------------------------------------
+
+def baseline_conversion_table(model):
+    """Conversion table exactly as the original load_efficientnet built it"""
+
+    # This will store the enire conversion table
+    conversion_table = {}
+    merge = lambda dict1, dict2: {**dict1, **dict2}
+
+    # All the weights not in the conv blocks
+    conversion_table_for_weights_outside_blocks = {
+        model._conv_stem.weight: 'stem/conv2d/kernel',  # [3, 3, 3, 32]),
+        model._bn0.bias: 'stem/tpu_batch_normalization/beta',  # [32]),
+        model._bn0.weight: 'stem/tpu_batch_normalization/gamma',  # [32]),
+        model._bn0.running_mean: 'stem/tpu_batch_normalization/moving_mean',  # [32]),
+        model._bn0.running_var: 'stem/tpu_batch_normalization/moving_variance',  # [32]),
+        model._conv_head.weight: 'head/conv2d/kernel',  # [1, 1, 320, 1280]),
+        model._bn1.bias: 'head/tpu_batch_normalization/beta',  # [1280]),
+        model._bn1.weight: 'head/tpu_batch_normalization/gamma',  # [1280]),
+        model._bn1.running_mean: 'head/tpu_batch_normalization/moving_mean',  # [32]),
+        model._bn1.running_var: 'head/tpu_batch_normalization/moving_variance',  # [32]),
+        model._fc.bias: 'head/dense/bias',  # [1000]),
+        model._fc.weight: 'head/dense/kernel',  # [1280, 1000]),
+    }
+    conversion_table = merge(conversion_table, conversion_table_for_weights_outside_blocks)
+
+    # The first conv block is special because it does not have _expand_conv
+    conversion_table_for_first_block = {
+        model._blocks[0]._project_conv.weight: 'blocks_0/conv2d/kernel',  # 1, 1, 32, 16]),
+        model._blocks[0]._depthwise_conv.weight: 'blocks_0/depthwise_conv2d/depthwise_kernel',  # [3, 3, 32, 1]),
+        model._blocks[0]._se_reduce.bias: 'blocks_0/se/conv2d/bias',  # , [8]),
+        model._blocks[0]._se_reduce.weight: 'blocks_0/se/conv2d/kernel',  # , [1, 1, 32, 8]),
+        model._blocks[0]._se_expand.bias: 'blocks_0/se/conv2d_1/bias',  # , [32]),
+        model._blocks[0]._se_expand.weight: 'blocks_0/se/conv2d_1/kernel',  # , [1, 1, 8, 32]),
+        model._blocks[0]._bn1.bias: 'blocks_0/tpu_batch_normalization/beta',  # [32]),
+        model._blocks[0]._bn1.weight: 'blocks_0/tpu_batch_normalization/gamma',  # [32]),
+        model._blocks[0]._bn1.running_mean: 'blocks_0/tpu_batch_normalization/moving_mean',
+        model._blocks[0]._bn1.running_var: 'blocks_0/tpu_batch_normalization/moving_variance',
+        model._blocks[0]._bn2.bias: 'blocks_0/tpu_batch_normalization_1/beta',  # [16]),
+        model._blocks[0]._bn2.weight: 'blocks_0/tpu_batch_normalization_1/gamma',  # [16]),
+        model._blocks[0]._bn2.running_mean: 'blocks_0/tpu_batch_normalization_1/moving_mean',
+        model._blocks[0]._bn2.running_var: 'blocks_0/tpu_batch_normalization_1/moving_variance',
+    }
+    conversion_table = merge(conversion_table, conversion_table_for_first_block)
+
+    # Conv blocks
+    for i in range(len(model._blocks)):
+
+        is_first_block = '_expand_conv.weight' not in [n for n, p in model._blocks[i].named_parameters()]
+
+        if is_first_block:
+            conversion_table_block = {
+                model._blocks[i]._project_conv.weight: 'blocks_' + str(i) + '/conv2d/kernel',  # 1, 1, 32, 16]),
+                model._blocks[i]._depthwise_conv.weight: 'blocks_' + str(i) + '/depthwise_conv2d/depthwise_kernel',
+                # [3, 3, 32, 1]),
+                model._blocks[i]._se_reduce.bias: 'blocks_' + str(i) + '/se/conv2d/bias',  # , [8]),
+                model._blocks[i]._se_reduce.weight: 'blocks_' + str(i) + '/se/conv2d/kernel',  # , [1, 1, 32, 8]),
+                model._blocks[i]._se_expand.bias: 'blocks_' + str(i) + '/se/conv2d_1/bias',  # , [32]),
+                model._blocks[i]._se_expand.weight: 'blocks_' + str(i) + '/se/conv2d_1/kernel',  # , [1, 1, 8, 32]),
+                model._blocks[i]._bn1.bias: 'blocks_' + str(i) + '/tpu_batch_normalization/beta',  # [32]),
+                model._blocks[i]._bn1.weight: 'blocks_' + str(i) + '/tpu_batch_normalization/gamma',  # [32]),
+                model._blocks[i]._bn1.running_mean: 'blocks_' + str(i) + '/tpu_batch_normalization/moving_mean',
+                model._blocks[i]._bn1.running_var: 'blocks_' + str(i) + '/tpu_batch_normalization/moving_variance',
+                model._blocks[i]._bn2.bias: 'blocks_' + str(i) + '/tpu_batch_normalization_1/beta',  # [16]),
+                model._blocks[i]._bn2.weight: 'blocks_' + str(i) + '/tpu_batch_normalization_1/gamma',  # [16]),
+                model._blocks[i]._bn2.running_mean: 'blocks_' + str(i) + '/tpu_batch_normalization_1/moving_mean',
+                model._blocks[i]._bn2.running_var: 'blocks_' + str(i) + '/tpu_batch_normalization_1/moving_variance',
+            }
+
+        else:
+            conversion_table_block = {
+                model._blocks[i]._expand_conv.weight:       'blocks_' + str(i) + '/conv2d/kernel',
+                model._blocks[i]._project_conv.weight:      'blocks_' + str(i) + '/conv2d_1/kernel',
+                model._blocks[i]._depthwise_conv.weight:    'blocks_' + str(i) + '/depthwise_conv2d/depthwise_kernel',
+                model._blocks[i]._se_reduce.bias:           'blocks_' + str(i) + '/se/conv2d/bias',
+                model._blocks[i]._se_reduce.weight:         'blocks_' + str(i) + '/se/conv2d/kernel',
+                model._blocks[i]._se_expand.bias:           'blocks_' + str(i) + '/se/conv2d_1/bias',
+                model._blocks[i]._se_expand.weight:         'blocks_' + str(i) + '/se/conv2d_1/kernel',
+                model._blocks[i]._bn0.bias:                 'blocks_' + str(i) + '/tpu_batch_normalization/beta',
+                model._blocks[i]._bn0.weight:               'blocks_' + str(i) + '/tpu_batch_normalization/gamma',
+                model._blocks[i]._bn0.running_mean:         'blocks_' + str(i) + '/tpu_batch_normalization/moving_mean',
+                model._blocks[i]._bn0.running_var:          'blocks_' + str(i) + '/tpu_batch_normalization/moving_variance',
+                model._blocks[i]._bn1.bias:                 'blocks_' + str(i) + '/tpu_batch_normalization_1/beta',
+                model._blocks[i]._bn1.weight:               'blocks_' + str(i) + '/tpu_batch_normalization_1/gamma',
+                model._blocks[i]._bn1.running_mean:         'blocks_' + str(i) + '/tpu_batch_normalization_1/moving_mean',
+                model._blocks[i]._bn1.running_var:          'blocks_' + str(i) + '/tpu_batch_normalization_1/moving_variance',
+                model._blocks[i]._bn2.bias:                 'blocks_' + str(i) + '/tpu_batch_normalization_2/beta',
+                model._blocks[i]._bn2.weight:               'blocks_' + str(i) + '/tpu_batch_normalization_2/gamma',
+                model._blocks[i]._bn2.running_mean:         'blocks_' + str(i) + '/tpu_batch_normalization_2/moving_mean',
+                model._blocks[i]._bn2.running_var:          'blocks_' + str(i) + '/tpu_batch_normalization_2/moving_variance',
+            }
+
+        conversion_table = merge(conversion_table, conversion_table_block)
+
+    return conversion_table
+
+
+class FakeCheckpointReader(object):
+    """Stands in for tf.train.load_checkpoint's reader, recording which variables were read"""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.reads = []
+
+    def get_tensor(self, name):
+        self.reads.append(name)
+        return self.arrays[name]
+
+
+def tf_layout_shape(tf_param_name, shape):
+    """TensorFlow shape of a variable whose PyTorch counterpart has `shape`"""
+    shape = tuple(shape)
+    if 'conv' in tf_param_name and 'kernel' in tf_param_name:
+        if 'depthwise' in tf_param_name:
+            return shape[2], shape[3], shape[0], shape[1]
+        return shape[2], shape[3], shape[1], shape[0]
+    elif tf_param_name.endswith('kernel'):
+        return tuple(reversed(shape))
+    return shape
+
+
+def baseline_transform(tf_param, tf_param_name):
+    """Kernel rearrangement exactly as the original load_param did it"""
+    if 'conv' in tf_param_name and 'kernel' in tf_param_name:
+        tf_param = np.transpose(tf_param, (3, 2, 0, 1))
+        if 'depthwise' in tf_param_name:
+            tf_param = np.transpose(tf_param, (1, 0, 2, 3))
+    elif tf_param_name.endswith('kernel'):
+        tf_param = np.transpose(tf_param)
+    return tf_param
+
+
+def baseline_transform_tag(tf_param_name, shape):
+    """Transform tag implied by the original name-based rules and the PyTorch shape"""
+    if 'conv' in tf_param_name and 'kernel' in tf_param_name:
+        if 'depthwise' in tf_param_name:
+            return DEPTHWISE_KERNEL
+        return POINTWISE_KERNEL if tuple(shape[2:]) == (1, 1) else CONV_KERNEL
+    elif tf_param_name.endswith('kernel'):
+        return DENSE_KERNEL
+    return IDENTITY
+
+
+# -- tests ----------------------------------------------------------------------------------------
+
+@pytest.mark.parametrize('transform, tf_param_name, shape', [
+    (IDENTITY, 'blocks_1/tpu_batch_normalization/beta', (32,)),
+    (CONV_KERNEL, 'stem/conv2d/kernel', (3, 3, 3, 32)),
+    (POINTWISE_KERNEL, 'blocks_1/conv2d/kernel', (1, 1, 32, 16)),
+    (DEPTHWISE_KERNEL, 'blocks_1/depthwise_conv2d/depthwise_kernel', (5, 5, 32, 1)),
+    (DENSE_KERNEL, 'head/dense/kernel', (64, 10)),
+])
+def test_transforms_match_baseline(transform, tf_param_name, shape):
+    """Test each transform rearranges a kernel exactly like the original name-based transposes"""
+    tf_param = np.random.rand(*shape).astype(np.float32)
+    expected = torch.from_numpy(np.ascontiguousarray(baseline_transform(tf_param, tf_param_name)))
+    output = TRANSFORMS[transform](torch.from_numpy(tf_param))
+    assert output.shape == expected.shape
+    assert torch.equal(output, expected)
+
+
+def test_build_name_table_matches_baseline(model):
+    """Test the cached name table maps every tensor to the original checkpoint name and transform"""
+    first_block_flags = tuple(not hasattr(block, '_expand_conv') for block in model._blocks)
+    name_table = load_tf_weights.build_name_table(first_block_flags)
+    table = {id(attrgetter(path)(model)): entry for path, entry in name_table}
+
+    baseline = baseline_conversion_table(model)
+    assert len(table) == len(name_table) == len(baseline)
+    for pyt_param, tf_param_name in baseline.items():
+        name, transform = table[id(pyt_param)]
+        assert name == tf_param_name
+        assert transform == baseline_transform_tag(tf_param_name, pyt_param.shape)
+
+
+def test_load_efficientnet_matches_baseline(checkpoint, monkeypatch):
+    """Test every tensor is copied into its existing storage with the original rearrangement, on the CPU by default"""
+    net, names, reader = checkpoint
+    before = {key: (id(tensor), tensor.data_ptr()) for key, tensor in net.state_dict(keep_vars=True).items()}
+
+    def no_cuda(self, *args, **kwargs):
+        raise AssertionError('cuda_transpose must be off by default')
+    monkeypatch.setattr(torch.Tensor, 'cuda', no_cuda)
+
+    load_tf_weights.load_efficientnet(net, 'checkpoint', model_name='efficientnet-b0')
+
+    assert sorted(reader.reads) == sorted(reader.arrays)
+    for key, tensor in net.state_dict(keep_vars=True).items():
+        assert (id(tensor), tensor.data_ptr()) == before[key], key
+        if key.endswith('num_batches_tracked'):
+            continue
+        tf_param_name = names[id(tensor)]
+        expected = np.ascontiguousarray(baseline_transform(reader.arrays[tf_param_name], tf_param_name))
+        assert torch.equal(tensor.detach(), torch.from_numpy(expected)), key
+
+
+def test_load_efficientnet_rejects_float64(checkpoint):
+    """Test a float64 variable fails the load before any later variable is read"""
+    net, names, reader = checkpoint
+    tf_param_name = names[id(net._bn0.running_mean)]
+    reader.arrays[tf_param_name] = reader.arrays[tf_param_name].astype(np.float64)
+
+    with pytest.raises(AssertionError):
+        load_tf_weights.load_efficientnet(net, 'checkpoint', model_name='efficientnet-b0')
+    assert reader.reads[-1] == tf_param_name
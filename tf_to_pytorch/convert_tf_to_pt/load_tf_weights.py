@@ -1,132 +1,157 @@
-import numpy as np
-import tensorflow as tf
+import functools
+from operator import attrgetter
+
 import torch
 
-tf.compat.v1.disable_v2_behavior()
+# How each checkpoint variable must be rearranged to match its PyTorch counterpart
+IDENTITY = 0          # biases and batch norm statistics
+CONV_KERNEL = 1       # [H, W, C_in, C_out] -> [C_out, C_in, H, W]
+POINTWISE_KERNEL = 2  # [1, 1, C_in, C_out] -> [C_out, C_in, 1, 1]
+DEPTHWISE_KERNEL = 3  # [H, W, C, 1] -> [C, 1, H, W]
+DENSE_KERNEL = 4      # [C_in, C_out] -> [C_out, C_in]
+
+TRANSFORMS = {
+    IDENTITY: lambda x: x,
+    CONV_KERNEL: lambda x: x.permute(3, 2, 0, 1),
+    POINTWISE_KERNEL: lambda x: x.reshape(x.shape[2:]).t().reshape(x.shape[3], x.shape[2], 1, 1),
+    DEPTHWISE_KERNEL: lambda x: x.permute(2, 3, 0, 1),
+    DENSE_KERNEL: lambda x: x.t(),
+}
+
+# With cuda_transpose, kernels at least this large are rearranged on the GPU
+CUDA_TRANSPOSE_MIN_NUMEL = 2 ** 18
+
 
-def load_param(checkpoint_file, conversion_table, model_name):
+def load_param(checkpoint_file, conversion_table, model_name, cuda_transpose=False):
     """
     Load parameters according to conversion_table.
 
     Args:
         checkpoint_file (string): pretrained checkpoint model file in tensorflow
-        conversion_table (dict): { pytorch tensor in a model : checkpoint variable name }
+        conversion_table (dict): { pytorch tensor in a model : (checkpoint variable name, transform) }
+        cuda_transpose (bool): rearrange large kernels on the GPU (off by default, the round trip is rarely worth it)
     """
-    for pyt_param, tf_param_name in conversion_table.items():
-        tf_param_name = str(model_name) + '/' +  tf_param_name
-        tf_param = tf.train.load_variable(checkpoint_file, tf_param_name)
-        if 'conv' in tf_param_name and 'kernel' in tf_param_name:
-            tf_param = np.transpose(tf_param, (3, 2, 0, 1))
-            if 'depthwise' in tf_param_name:
-                tf_param = np.transpose(tf_param, (1, 0, 2, 3))
-        elif tf_param_name.endswith('kernel'):  # for weight(kernel), we should do transpose
-            tf_param = np.transpose(tf_param)
-        assert pyt_param.size() == tf_param.shape, \
-            'Dim Mismatch: %s vs %s ; %s' % (tuple(pyt_param.size()), tf_param.shape, tf_param_name)
-        pyt_param.data = torch.from_numpy(tf_param)
-
-
-def load_efficientnet(model, checkpoint_file, model_name):
+    # TensorFlow is imported lazily, so the conversion tables can be used without paying for it
+    import tensorflow as tf
+
+    # Open the checkpoint once, rather than re-parsing its index for every variable
+    reader = tf.train.load_checkpoint(checkpoint_file)
+
+    # Variables are read one at a time, so besides the model at most two raw arrays are alive: the
+    # current one, and the next while get_tensor allocates it. TF's reader has no mmap mode.
+    # Reading, rearranging and copying stay interleaved per variable: splitting them into phases over
+    # all variables would keep every raw array alive at once, with no concurrent reads to overlap.
+    # Parameters and batch norm buffers are both updated in place, keeping tensor identity stable
+    use_cuda = cuda_transpose and torch.cuda.is_available()
+    with torch.no_grad():
+        for pyt_param, (tf_param_name, transform) in conversion_table.items():
+            tf_param_name = str(model_name) + '/' +  tf_param_name
+            tf_param = torch.from_numpy(reader.get_tensor(tf_param_name))
+            assert tf_param.dtype == torch.float32, 'Dtype Mismatch: %s ; %s' % (tf_param.dtype, tf_param_name)
+            if use_cuda and transform != IDENTITY and tf_param.numel() >= CUDA_TRANSPOSE_MIN_NUMEL:
+                tf_param = TRANSFORMS[transform](tf_param.cuda()).contiguous()
+            else:
+                tf_param = TRANSFORMS[transform](tf_param)
+            assert pyt_param.shape == tf_param.shape, \
+                'Dim Mismatch: %s vs %s ; %s' % (tuple(pyt_param.size()), tuple(tf_param.size()), tf_param_name)
+            # copy_ follows the source strides, so no contiguous temporary is needed on the CPU path
+            pyt_param.copy_(tf_param)
+
+
+def _block_table(idx, is_first):
     """
-    Load PyTorch EfficientNet from TensorFlow checkpoint file
+    Build the conversion table entries of a single conv block.
+
+    Args:
+        idx (int): index of the block in model._blocks
+        is_first (bool): whether the block lacks an _expand_conv (and therefore _bn0)
+    Returns:
+        dict: { pytorch tensor attribute path : (checkpoint variable name, transform) }
     """
+    pyt_prefix = '_blocks.{}.'.format(idx)
+    tf_prefix = 'blocks_{}/'.format(idx)
+
+    # Without _expand_conv, the TF conv and batch norm layer indices are shifted down by one
+    bn_layers = ['_bn1', '_bn2'] if is_first else ['_bn0', '_bn1', '_bn2']
+    project_conv = 'conv2d' if is_first else 'conv2d_1'
+
+    table = {
+        pyt_prefix + '_project_conv.weight':   (tf_prefix + project_conv + '/kernel', POINTWISE_KERNEL),
+        pyt_prefix + '_depthwise_conv.weight': (tf_prefix + 'depthwise_conv2d/depthwise_kernel', DEPTHWISE_KERNEL),
+        pyt_prefix + '_se_reduce.bias':        (tf_prefix + 'se/conv2d/bias', IDENTITY),
+        pyt_prefix + '_se_reduce.weight':      (tf_prefix + 'se/conv2d/kernel', POINTWISE_KERNEL),
+        pyt_prefix + '_se_expand.bias':        (tf_prefix + 'se/conv2d_1/bias', IDENTITY),
+        pyt_prefix + '_se_expand.weight':      (tf_prefix + 'se/conv2d_1/kernel', POINTWISE_KERNEL),
+    }
+    if not is_first:
+        table[pyt_prefix + '_expand_conv.weight'] = (tf_prefix + 'conv2d/kernel', POINTWISE_KERNEL)
+
+    for j, bn in enumerate(bn_layers):
+        tf_bn = tf_prefix + 'tpu_batch_normalization' + ('_{}'.format(j) if j else '') + '/'
+        table[pyt_prefix + bn + '.bias'] = (tf_bn + 'beta', IDENTITY)
+        table[pyt_prefix + bn + '.weight'] = (tf_bn + 'gamma', IDENTITY)
+        table[pyt_prefix + bn + '.running_mean'] = (tf_bn + 'moving_mean', IDENTITY)
+        table[pyt_prefix + bn + '.running_var'] = (tf_bn + 'moving_variance', IDENTITY)
+
+    return table
 
-    # This will store the enire conversion table
-    conversion_table = {}
-    merge = lambda dict1, dict2: {**dict1, **dict2}
+
+@functools.lru_cache(maxsize=None)
+def build_name_table(first_block_flags):
+    """
+    Build the model-independent part of the conversion table.
+
+    Args:
+        first_block_flags (tuple): for each block, whether it lacks an _expand_conv
+    Returns:
+        tuple: ((pytorch tensor attribute path, (checkpoint variable name, transform)), ...), immutable
+            because the same object is returned to every caller
+    """
 
     # All the weights not in the conv blocks
     conversion_table_for_weights_outside_blocks = {
-        model._conv_stem.weight: 'stem/conv2d/kernel',  # [3, 3, 3, 32]),
-        model._bn0.bias: 'stem/tpu_batch_normalization/beta',  # [32]),
-        model._bn0.weight: 'stem/tpu_batch_normalization/gamma',  # [32]),
-        model._bn0.running_mean: 'stem/tpu_batch_normalization/moving_mean',  # [32]),
-        model._bn0.running_var: 'stem/tpu_batch_normalization/moving_variance',  # [32]),
-        model._conv_head.weight: 'head/conv2d/kernel',  # [1, 1, 320, 1280]),
-        model._bn1.bias: 'head/tpu_batch_normalization/beta',  # [1280]),
-        model._bn1.weight: 'head/tpu_batch_normalization/gamma',  # [1280]),
-        model._bn1.running_mean: 'head/tpu_batch_normalization/moving_mean',  # [32]),
-        model._bn1.running_var: 'head/tpu_batch_normalization/moving_variance',  # [32]),
-        model._fc.bias: 'head/dense/bias',  # [1000]),
-        model._fc.weight: 'head/dense/kernel',  # [1280, 1000]),
-    }
-    conversion_table = merge(conversion_table, conversion_table_for_weights_outside_blocks)
-
-    # The first conv block is special because it does not have _expand_conv
-    conversion_table_for_first_block = {
-        model._blocks[0]._project_conv.weight: 'blocks_0/conv2d/kernel',  # 1, 1, 32, 16]),
-        model._blocks[0]._depthwise_conv.weight: 'blocks_0/depthwise_conv2d/depthwise_kernel',  # [3, 3, 32, 1]),
-        model._blocks[0]._se_reduce.bias: 'blocks_0/se/conv2d/bias',  # , [8]),
-        model._blocks[0]._se_reduce.weight: 'blocks_0/se/conv2d/kernel',  # , [1, 1, 32, 8]),
-        model._blocks[0]._se_expand.bias: 'blocks_0/se/conv2d_1/bias',  # , [32]),
-        model._blocks[0]._se_expand.weight: 'blocks_0/se/conv2d_1/kernel',  # , [1, 1, 8, 32]),
-        model._blocks[0]._bn1.bias: 'blocks_0/tpu_batch_normalization/beta',  # [32]),
-        model._blocks[0]._bn1.weight: 'blocks_0/tpu_batch_normalization/gamma',  # [32]),
-        model._blocks[0]._bn1.running_mean: 'blocks_0/tpu_batch_normalization/moving_mean',
-        model._blocks[0]._bn1.running_var: 'blocks_0/tpu_batch_normalization/moving_variance',
-        model._blocks[0]._bn2.bias: 'blocks_0/tpu_batch_normalization_1/beta',  # [16]),
-        model._blocks[0]._bn2.weight: 'blocks_0/tpu_batch_normalization_1/gamma',  # [16]),
-        model._blocks[0]._bn2.running_mean: 'blocks_0/tpu_batch_normalization_1/moving_mean',
-        model._blocks[0]._bn2.running_var: 'blocks_0/tpu_batch_normalization_1/moving_variance',
+        '_conv_stem.weight': ('stem/conv2d/kernel', CONV_KERNEL),  # [3, 3, 3, 32]),
+        '_bn0.bias': ('stem/tpu_batch_normalization/beta', IDENTITY),  # [32]),
+        '_bn0.weight': ('stem/tpu_batch_normalization/gamma', IDENTITY),  # [32]),
+        '_bn0.running_mean': ('stem/tpu_batch_normalization/moving_mean', IDENTITY),  # [32]),
+        '_bn0.running_var': ('stem/tpu_batch_normalization/moving_variance', IDENTITY),  # [32]),
+        '_conv_head.weight': ('head/conv2d/kernel', POINTWISE_KERNEL),  # [1, 1, 320, 1280]),
+        '_bn1.bias': ('head/tpu_batch_normalization/beta', IDENTITY),  # [1280]),
+        '_bn1.weight': ('head/tpu_batch_normalization/gamma', IDENTITY),  # [1280]),
+        '_bn1.running_mean': ('head/tpu_batch_normalization/moving_mean', IDENTITY),  # [32]),
+        '_bn1.running_var': ('head/tpu_batch_normalization/moving_variance', IDENTITY),  # [32]),
+        '_fc.bias': ('head/dense/bias', IDENTITY),  # [1000]),
+        '_fc.weight': ('head/dense/kernel', DENSE_KERNEL),  # [1280, 1000]),
     }
-    conversion_table = merge(conversion_table, conversion_table_for_first_block)
+
+    # Collect every (pytorch tensor path, checkpoint entry) pair, and build the result once at the end
+    conversion_pairs = list(conversion_table_for_weights_outside_blocks.items())
 
     # Conv blocks
-    for i in range(len(model._blocks)):
-
-        is_first_block = '_expand_conv.weight' not in [n for n, p in model._blocks[i].named_parameters()]
-
-        if is_first_block:
-            conversion_table_block = {
-                model._blocks[i]._project_conv.weight: 'blocks_' + str(i) + '/conv2d/kernel',  # 1, 1, 32, 16]),
-                model._blocks[i]._depthwise_conv.weight: 'blocks_' + str(i) + '/depthwise_conv2d/depthwise_kernel',
-                # [3, 3, 32, 1]),
-                model._blocks[i]._se_reduce.bias: 'blocks_' + str(i) + '/se/conv2d/bias',  # , [8]),
-                model._blocks[i]._se_reduce.weight: 'blocks_' + str(i) + '/se/conv2d/kernel',  # , [1, 1, 32, 8]),
-                model._blocks[i]._se_expand.bias: 'blocks_' + str(i) + '/se/conv2d_1/bias',  # , [32]),
-                model._blocks[i]._se_expand.weight: 'blocks_' + str(i) + '/se/conv2d_1/kernel',  # , [1, 1, 8, 32]),
-                model._blocks[i]._bn1.bias: 'blocks_' + str(i) + '/tpu_batch_normalization/beta',  # [32]),
-                model._blocks[i]._bn1.weight: 'blocks_' + str(i) + '/tpu_batch_normalization/gamma',  # [32]),
-                model._blocks[i]._bn1.running_mean: 'blocks_' + str(i) + '/tpu_batch_normalization/moving_mean',
-                model._blocks[i]._bn1.running_var: 'blocks_' + str(i) + '/tpu_batch_normalization/moving_variance',
-                model._blocks[i]._bn2.bias: 'blocks_' + str(i) + '/tpu_batch_normalization_1/beta',  # [16]),
-                model._blocks[i]._bn2.weight: 'blocks_' + str(i) + '/tpu_batch_normalization_1/gamma',  # [16]),
-                model._blocks[i]._bn2.running_mean: 'blocks_' + str(i) + '/tpu_batch_normalization_1/moving_mean',
-                model._blocks[i]._bn2.running_var: 'blocks_' + str(i) + '/tpu_batch_normalization_1/moving_variance',
-            }
-
-        else:
-            conversion_table_block = {
-                model._blocks[i]._expand_conv.weight:       'blocks_' + str(i) + '/conv2d/kernel',
-                model._blocks[i]._project_conv.weight:      'blocks_' + str(i) + '/conv2d_1/kernel',
-                model._blocks[i]._depthwise_conv.weight:    'blocks_' + str(i) + '/depthwise_conv2d/depthwise_kernel',
-                model._blocks[i]._se_reduce.bias:           'blocks_' + str(i) + '/se/conv2d/bias',
-                model._blocks[i]._se_reduce.weight:         'blocks_' + str(i) + '/se/conv2d/kernel',
-                model._blocks[i]._se_expand.bias:           'blocks_' + str(i) + '/se/conv2d_1/bias',
-                model._blocks[i]._se_expand.weight:         'blocks_' + str(i) + '/se/conv2d_1/kernel',
-                model._blocks[i]._bn0.bias:                 'blocks_' + str(i) + '/tpu_batch_normalization/beta',
-                model._blocks[i]._bn0.weight:               'blocks_' + str(i) + '/tpu_batch_normalization/gamma',
-                model._blocks[i]._bn0.running_mean:         'blocks_' + str(i) + '/tpu_batch_normalization/moving_mean',
-                model._blocks[i]._bn0.running_var:          'blocks_' + str(i) + '/tpu_batch_normalization/moving_variance',
-                model._blocks[i]._bn1.bias:                 'blocks_' + str(i) + '/tpu_batch_normalization_1/beta',
-                model._blocks[i]._bn1.weight:               'blocks_' + str(i) + '/tpu_batch_normalization_1/gamma',
-                model._blocks[i]._bn1.running_mean:         'blocks_' + str(i) + '/tpu_batch_normalization_1/moving_mean',
-                model._blocks[i]._bn1.running_var:          'blocks_' + str(i) + '/tpu_batch_normalization_1/moving_variance',
-                model._blocks[i]._bn2.bias:                 'blocks_' + str(i) + '/tpu_batch_normalization_2/beta',
-                model._blocks[i]._bn2.weight:               'blocks_' + str(i) + '/tpu_batch_normalization_2/gamma',
-                model._blocks[i]._bn2.running_mean:         'blocks_' + str(i) + '/tpu_batch_normalization_2/moving_mean',
-                model._blocks[i]._bn2.running_var:          'blocks_' + str(i) + '/tpu_batch_normalization_2/moving_variance',
-            }
-
-        conversion_table = merge(conversion_table, conversion_table_block)
+    for i, is_first_block in enumerate(first_block_flags):
+        conversion_pairs.extend(_block_table(i, is_first_block).items())
+
+    return tuple(conversion_pairs)
+
+
+def load_efficientnet(model, checkpoint_file, model_name, cuda_transpose=False):
+    """
+    Load PyTorch EfficientNet from TensorFlow checkpoint file
+    """
+
+    # The checkpoint names only depend on the block layout, so they are cached for models of the same layout
+    first_block_flags = tuple(not hasattr(block, '_expand_conv') for block in model._blocks)
+    conversion_table = {attrgetter(path)(model): entry
+                        for path, entry in build_name_table(first_block_flags)}
 
     # Load TensorFlow parameters into PyTorch model
-    load_param(checkpoint_file, conversion_table, model_name)
+    load_param(checkpoint_file, conversion_table, model_name, cuda_transpose=cuda_transpose)
     return conversion_table
 
 
 def load_and_save_temporary_tensorflow_model(model_name, model_ckpt, example_img= '../../example/img.jpg'):
     """ Loads and saves a TensorFlow model. """
+    import tensorflow as tf
     image_files = [example_img]
     eval_ckpt_driver = eval_ckpt_main.EvalCkptDriver(model_name)
     with tf.Graph().as_default(), tf.compat.v1.Session() as sess:
@@ -143,6 +168,9 @@ if __name__ == '__main__':
     import sys
     import argparse
 
+    import tensorflow as tf
+    tf.compat.v1.disable_v2_behavior()
+
     sys.path.append('original_tf')
     import eval_ckpt_main
 
@@ -156,6 +184,10 @@ if __name__ == '__main__':
                         help='checkpoint file path')
     parser.add_argument('--output_file', type=str, default='pretrained_pytorch/efficientnet-b0.pth',
                         help='output PyTorch model file name')
+    parser.add_argument('--cuda_transpose', action='store_true',
+                        help='rearrange the largest kernels on the GPU, if one is available')
+    parser.add_argument('--half_bn', action='store_true',
+                        help='store batch norm statistics and biases as float16 to reduce file size')
     args = parser.parse_args()
 
     # Build model
@@ -166,9 +198,14 @@ if __name__ == '__main__':
     load_and_save_temporary_tensorflow_model(args.model_name, args.tf_checkpoint)
 
     # Load weights
-    load_efficientnet(model, 'tmp/model.ckpt', model_name=args.model_name)
+    load_efficientnet(model, 'tmp/model.ckpt', model_name=args.model_name, cuda_transpose=args.cuda_transpose)
     print('Loaded TF checkpoint weights')
 
     # Save PyTorch file
-    torch.save(model.state_dict(), args.output_file)
+    state_dict = model.state_dict()
+    if args.half_bn:
+        for key, value in state_dict.items():
+            if key.endswith(('running_mean', 'running_var', 'bias')):
+                state_dict[key] = value.half()
+    torch.save(state_dict, args.output_file)
     print('Saved model to', args.output_file)